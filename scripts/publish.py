@@ -4,111 +4,283 @@
 # It should be run in the root of wasmer like `python3 scripts/publish.py --no-dry-run`.
 # By default the script executes a test run and does not publish the crates to crates.io.
 
-# install dependencies:
-# pip3 install toposort
+# install dependencies (only needed before Python 3.11):
+# pip3 install tomli
 
 import argparse
+import atexit
+import glob
+import hashlib
+import http.client
+import json
 import os
 import re
 import subprocess
+import sys
 import time
+import urllib.error
+import urllib.request
 
-from typing import Optional
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 try:
-    from toposort import toposort_flatten
+    import tomllib
 except ImportError:
-    print("Please install toposort, `pip3 install toposort`")
+    try:
+        import tomli as tomllib
+    except ImportError:
+        print("Please install tomli, `pip3 install tomli`")
 
 
 # TODO: find this automatically
 target_version = "2.0.0"
 
-# TODO: generate this by parsing toml files
-dep_graph = {
-    "wasmer-types": set([]),
-    "wasmer-derive": set([]),
-    "wasmer-vm": set(["wasmer-types"]),
-    "wasmer-compiler": set(["wasmer-vm", "wasmer-types"]),
-    "wasmer-object": set(["wasmer-types", "wasmer-compiler"]),
-    "wasmer-engine": set(["wasmer-types", "wasmer-vm", "wasmer-compiler"]),
-    "wasmer-compiler-singlepass": set(["wasmer-types", "wasmer-vm", "wasmer-compiler"]),
-    "wasmer-compiler-cranelift": set(["wasmer-types", "wasmer-vm", "wasmer-compiler"]),
-    "wasmer-compiler-llvm": set(["wasmer-types", "wasmer-vm", "wasmer-compiler"]),
-    "wasmer-engine-universal": set(["wasmer-types", "wasmer-vm", "wasmer-compiler", "wasmer-engine"]),
-    "wasmer-engine-dylib": set(["wasmer-types", "wasmer-vm", "wasmer-compiler", "wasmer-engine",
-                                 "wasmer-object"]),
-    "wasmer-engine-staticlib": set(["wasmer-types", "wasmer-vm", "wasmer-compiler", "wasmer-engine",
-                                      "wasmer-object"]),
-    "wasmer": set(["wasmer-vm", "wasmer-compiler-singlepass", "wasmer-compiler-cranelift",
-                   "wasmer-compiler-llvm", "wasmer-compiler", "wasmer-engine", "wasmer-engine-universal",
-                   "wasmer-engine-dylib", "wasmer-engine-staticlib", "wasmer-types", "wasmer-derive"]),
-    "wasmer-cache": set(["wasmer"]),
-    "wasmer-wasi": set(["wasmer", "wasmer-wasi-types"]),
-    "wasmer-wasi-types": set(["wasmer-types"]),
-    "wasmer-wasi-experimental-io-devices": set(["wasmer-wasi"]),
-    "wasmer-emscripten": set(["wasmer"]),
-    "wasmer-c-api": set(["wasmer", "wasmer-compiler", "wasmer-compiler-cranelift", "wasmer-compiler-singlepass",
-                         "wasmer-compiler-llvm", "wasmer-emscripten", "wasmer-engine", "wasmer-engine-universal",
-                         "wasmer-engine-dylib", "wasmer-engine-staticlib", "wasmer-wasi", "wasmer-types"]),
-    "wasmer-middlewares": set(["wasmer", "wasmer-types", "wasmer-vm"]),
-}
-
-# where each crate is located in the `lib` directory
-# TODO: this could also be generated from the toml files
-location = {
-    "wasmer-types": "types",
-    "wasmer-derive": "derive",
-    "wasmer-vm": "vm",
-    "wasmer-compiler": "compiler",
-    "wasmer-object": "object",
-    "wasmer-engine": "engine",
-    "wasmer-compiler-singlepass": "compiler-singlepass",
-    "wasmer-compiler-cranelift": "compiler-cranelift",
-    "wasmer-compiler-llvm": "compiler-llvm",
-    "wasmer-engine": "engine",
-    "wasmer-engine-universal": "engine-universal",
-    "wasmer-engine-dylib": "engine-dylib",
-    "wasmer-engine-staticlib": "engine-staticlib",
-    "wasmer-cache": "cache",
-    "wasmer": "api",
-    "wasmer-wasi": "wasi",
-    "wasmer-wasi-types": "wasi-types",
-    "wasmer-emscripten": "emscripten",
-    "wasmer-wasi-experimental-io-devices": "wasi-experimental-io-devices",
-    "wasmer-c-api": "c-api",
-    "wasmer-middlewares": "middlewares",
-}
+# the dependencies between the crates to publish, and the directory of each crate;
+# both are generated from the manifests by `load_workspace_graph`
+dep_graph: Dict[str, Set[str]] = {}
+location: Dict[str, str] = {}
+
+# the sections of a manifest that can depend on other crates of the workspace
+DEPENDENCY_SECTIONS = ("dependencies", "build-dependencies")
 
 no_dry_run = False
 
-def get_latest_version_for_crate(crate_name: str) -> Optional[str]:
-    output = subprocess.run(["cargo", "search", crate_name], capture_output=True)
-    rexp_src = '^{} = "([^"]+)"'.format(crate_name)
-    prog = re.compile(rexp_src)
-    haystack = output.stdout.decode("utf-8")
-    for line in haystack.splitlines():
-        result = prog.match(line)
-        if result:
-            return result.group(1)
+# a line of `cargo search` output, like `wasmer = "2.0.0"    # description`
+CARGO_SEARCH_LINE = re.compile(rb'^([A-Za-z0-9_-]+) = "([^"]+)"')
+
+# whether `target_version` of each crate is on crates.io, looked up once at startup
+target_version_published: Dict[str, bool] = {}
+
+# the crates known to be published at a given version, kept across runs so that
+# re-running the script after a failure doesn't have to look them up again;
+# only positive results are stored as a published version never goes away
+cache_dir = os.path.expanduser("~/.cache/wasmer-publish")
+published_versions_path = os.path.join(cache_dir, "versions.json")
+published_versions: Dict[str, str] = {}
+
+def local_dependencies(manifest) -> Dict[str, str]:
+    """Returns the path of each dependency of the manifest that is in the repository."""
+    deps = {}
+    for table in [manifest, *manifest.get("target", {}).values()]:
+        for section in DEPENDENCY_SECTIONS:
+            for (name, dep) in table.get(section, {}).items():
+                if isinstance(dep, dict) and "path" in dep:
+                    deps[dep.get("package", name)] = dep["path"]
+    return deps
+
+def read_manifest(crate_dir: str) -> bytes:
+    with open(os.path.join(crate_dir, "Cargo.toml"), "rb") as file:
+        return file.read()
+
+def manifest_digest(crate_dir: str) -> str:
+    return hashlib.sha256(read_manifest(crate_dir)).hexdigest()
+
+def load_workspace_graph() -> Tuple[Dict[str, Set[str]], Dict[str, str]]:
+    """Returns the dependency graph of the crates to publish, and the directory of each crate.
+
+    The crates to publish are the ones in `lib`, along with the local crates they depend on.
+    """
+    roots = sorted(os.path.dirname(path) for path in glob.glob("lib/*/Cargo.toml"))
+    graph_path = os.path.join(cache_dir, "graph.json")
+    # the extraction rules (`DEPENDENCY_SECTIONS`, `local_dependencies`, ...) live in this
+    # script, so a cache built by another version of it can't be trusted
+    with open(__file__, "rb") as file:
+        script_digest = hashlib.sha256(file.read()).hexdigest()
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        # the graph only changes when the script or one of the manifests it was built from does
+        try:
+            with open(graph_path) as file:
+                cached = json.load(file)
+            digests = cached["manifests"]
+            if cached["script"] == script_digest and set(roots) <= digests.keys() and \
+                    list(executor.map(manifest_digest, digests)) == list(digests.values()):
+                return ({crate: set(deps) for (crate, deps) in cached["dep_graph"].items()}, cached["location"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        graph: Dict[str, Set[str]] = {}
+        crate_location: Dict[str, str] = {}
+        digests = {}
+        seen = set(roots)
+        to_read = roots
+        while to_read:
+            next_to_read = []
+            for (crate_dir, manifest) in zip(to_read, executor.map(read_manifest, to_read)):
+                digests[crate_dir] = hashlib.sha256(manifest).hexdigest()
+                data = tomllib.loads(manifest.decode("utf-8"))
+                if data["package"].get("publish", True) is False:
+                    continue
+                crate = data["package"]["name"]
+                crate_location[crate] = crate_dir
+                deps = local_dependencies(data)
+                graph[crate] = set(deps)
+                for dep_path in deps.values():
+                    dep_dir = os.path.normpath(os.path.join(crate_dir, dep_path))
+                    if dep_dir not in seen:
+                        seen.add(dep_dir)
+                        next_to_read.append(dep_dir)
+            to_read = next_to_read
+
+    # only keep the dependencies on the crates being published
+    for deps in graph.values():
+        deps.intersection_update(graph)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(graph_path, "w") as file:
+        json.dump({"script": script_digest,
+                   "manifests": digests,
+                   "dep_graph": {crate: sorted(deps) for (crate, deps) in graph.items()},
+                   "location": crate_location}, file, indent=4, sort_keys=True)
+    return (graph, crate_location)
+
+def sparse_index_url(crate_name: str) -> str:
+    # see https://doc.rust-lang.org/cargo/reference/registry-index.html#index-files
+    name = crate_name.lower()
+    if len(name) <= 2:
+        prefix = str(len(name))
+    elif len(name) == 3:
+        prefix = "3/{}".format(name[0])
+    else:
+        prefix = "{}/{}".format(name[:2], name[2:4])
+    return "https://index.crates.io/{}/{}".format(prefix, name)
+
+def has_published_target_version(crate_name: str) -> bool:
+    try:
+        with urllib.request.urlopen(sparse_index_url(crate_name), timeout=30) as response:
+            records = response.read().decode("utf-8").splitlines()
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            # the crate has never been published
+            return False
+        return search_latest_version_for_crate(crate_name) == target_version
+    except (OSError, http.client.HTTPException):
+        # the index can't be reached or the connection broke off (this also covers
+        # `URLError` and timeouts while reading), let cargo try instead
+        return search_latest_version_for_crate(crate_name) == target_version
+
+    # the index file has one JSON record per version ever published, in publish order;
+    # a yanked version still can't be uploaded again so it counts as published
+    return any(json.loads(line)["vers"] == target_version for line in records if line)
+
+def search_latest_version_for_crate(crate_name: str) -> Optional[str]:
+    # `cargo search` only reports the latest version, which is the best the fallback can do
+    name = crate_name.encode("utf-8")
+    # read the output as it comes and stop cargo as soon as the crate has been found
+    with subprocess.Popen(["cargo", "search", crate_name], stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL) as proc:
+        for line in proc.stdout:
+            result = CARGO_SEARCH_LINE.match(line)
+            if result and result.group(1) == name:
+                proc.terminate()
+                return result.group(2).decode("utf-8")
+
+def load_published_versions():
+    try:
+        with open(published_versions_path) as file:
+            published_versions.update(json.load(file))
+    except (OSError, ValueError):
+        pass
+
+def save_published_versions():
+    os.makedirs(cache_dir, exist_ok=True)
+    # write the new state next to the old one and swap them, so that an interrupted
+    # run can't leave a truncated file behind
+    tmp_path = published_versions_path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(published_versions, file, indent=4, sort_keys=True)
+    os.replace(tmp_path, published_versions_path)
+
+def fetch_target_version_published(crates):
+    crates = [crate for crate in crates if published_versions.get(crate) != target_version]
+    # the lookups are dominated by network latency, so run all of them concurrently
+    # instead of one per crate while publishing
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        target_version_published.update(zip(crates, executor.map(has_published_target_version, crates)))
 
 def is_crate_already_published(crate_name: str) -> bool:
-    found_string = get_latest_version_for_crate(crate_name)
-    if found_string is None:
-        return False
+    if published_versions.get(crate_name) == target_version:
+        return True
 
-    return target_version == found_string
+    # every crate not already known to be published was looked up by `fetch_target_version_published`
+    if not target_version_published.get(crate_name):
+        return False
 
-def publish_crate(crate: str):
-    starting_dir = os.getcwd()
-    os.chdir("lib/{}".format(location[crate]))
+    published_versions[crate_name] = target_version
+    return True
 
+def publish_crates(crates: List[str]) -> List[str]:
+    """Publishes the given crates concurrently and returns the ones that failed to publish."""
     global no_dry_run
-    if no_dry_run:
-        output = subprocess.run(["cargo", "publish"])
-    else:
-        print("In dry-run: not publishing crate `{}`".format(crate))
+    if not no_dry_run:
+        for crate in crates:
+            print("In dry-run: not publishing crate `{}`".format(crate))
+        return []
+
+    # use `cwd` rather than `os.chdir` so that the crates can be published concurrently
+    procs = [(crate, subprocess.Popen(["cargo", "publish"], cwd=location[crate]))
+             for crate in crates]
+    return [crate for (crate, proc) in procs if proc.wait() != 0]
+
+def publish_layers(graph: Dict[str, Set[str]]) -> List[List[str]]:
+    """Groups the crates in layers, each crate only depending on crates of earlier layers.
+
+    This is Kahn's algorithm, run over the crate indices with the dependents of each crate
+    stored as a compressed sparse row adjacency.
+    """
+    names = sorted(graph)
+    index = {name: i for (i, name) in enumerate(names)}
+
+    # the dependents of crate `i` are `dependents[offsets[i]:offsets[i + 1]]`
+    offsets = array("i", [0] * (len(names) + 1))
+    for deps in graph.values():
+        for dep in deps:
+            offsets[index[dep] + 1] += 1
+    for i in range(len(names)):
+        offsets[i + 1] += offsets[i]
+    dependents = array("i", [0] * offsets[-1])
+    filled = offsets[:-1]
+    in_degree = array("i", [0] * len(names))
+    for (crate, deps) in graph.items():
+        i = index[crate]
+        in_degree[i] = len(deps)
+        for dep in deps:
+            d = index[dep]
+            dependents[filled[d]] = i
+            filled[d] += 1
 
-    os.chdir(starting_dir)
+    layers = []
+    layer = [i for i in range(len(names)) if in_degree[i] == 0]
+    while layer:
+        layers.append([names[i] for i in layer])
+        next_layer = []
+        for i in layer:
+            for j in dependents[offsets[i]:offsets[i + 1]]:
+                in_degree[j] -= 1
+                if in_degree[j] == 0:
+                    next_layer.append(j)
+        layer = sorted(next_layer)
+
+    if sum(len(layer) for layer in layers) != len(names):
+        raise ValueError("The crates have circular dependencies")
+    return layers
+
+def transitive_dependencies(graph: Dict[str, Set[str]]) -> Dict[str, Set[str]]:
+    closure: Dict[str, Set[str]] = {}
+
+    def visit(crate: str) -> Set[str]:
+        if crate not in closure:
+            deps = set()
+            for dep in graph.get(crate, ()):
+                deps.add(dep)
+                deps |= visit(dep)
+            closure[crate] = deps
+        return closure[crate]
+
+    for crate in graph:
+        visit(crate)
+    return closure
 
 def main():
     os.environ['WASMER_PUBLISH_SCRIPT_IS_RUNNING'] = '1'
@@ -120,24 +292,51 @@ def main():
     global no_dry_run
     no_dry_run = args['no_dry_run']
 
-    # get the order to publish the crates in
-    order = list(toposort_flatten(dep_graph, sort=True))
+    load_published_versions()
+    atexit.register(save_published_versions)
+
+    global dep_graph, location
+    (dep_graph, location) = load_workspace_graph()
 
-    for crate in order:
-        print("Publishing `{}`...".format(crate))
-        if not is_crate_already_published(crate):
-            publish_crate(crate)
-        else:
-            print("`{}` was already published!".format(crate))
+    # get the order to publish the crates in, grouped into layers: the crates of
+    # a layer only depend on crates of earlier layers so they can be published
+    # concurrently
+    layers = publish_layers(dep_graph)
+    fetch_target_version_published([crate for layer in layers for crate in layer])
+
+    all_deps = transitive_dependencies(dep_graph)
+    # the crates published since we last waited for the crates.io index to update
+    unsynced: Set[str] = set()
+
+    for layer in layers:
+        to_publish = []
+        for crate in layer:
+            if not is_crate_already_published(crate):
+                print("Publishing `{}`...".format(crate))
+                to_publish.append(crate)
+            else:
+                print("`{}` was already published!".format(crate))
+        if not to_publish:
             continue
-        # sleep for 16 seconds between crates to ensure the crates.io index has time to update
-        # this can be optimized with knowledge of our dep graph via toposort; we can even publish
-        # crates in parallel; however this is out of scope for the first version of this script
+
+        # sleep for 16 seconds to ensure the crates.io index has time to update, but only
+        # when one of the crates about to be published depends on a freshly published one
+        if any(all_deps[crate] & unsynced for crate in to_publish):
+            if no_dry_run:
+                print("Sleeping for 16 seconds to allow the `crates.io` index to update...")
+                time.sleep(16)
+            else:
+                print("In dry-run: not sleeping for crates.io to update.")
+            unsynced.clear()
+
+        failed = publish_crates(to_publish)
         if no_dry_run:
-            print("Sleeping for 16 seconds to allow the `crates.io` index to update...")
-            time.sleep(16)
-        else:
-            print("In dry-run: not sleeping for crates.io to update.")
+            published_versions.update((crate, target_version) for crate in to_publish if crate not in failed)
+            save_published_versions()
+        if failed:
+            print("Failed to publish {}".format(", ".join("`{}`".format(crate) for crate in failed)))
+            sys.exit(1)
+        unsynced.update(to_publish)
 
 
 if __name__ == "__main__":
@@ -1,17 +1,22 @@
 #! /bin/sh
 
-# How to install `fd`: https://github.com/sharkdp/fd#installation
-: "${FD:=fd}"
-
 # A script to update the version of all the crates at the same time
 PREVIOUS_VERSION='2.0.0-rc2'
 NEXT_VERSION='2.0.0'
 
-# quick hack
-${FD} Cargo.toml --exec sed -i '{}' -e "s/version = \"$PREVIOUS_VERSION\"/version = \"$NEXT_VERSION\"/"
-echo "manually check changes to Cargo.toml"
+# The versions are matched literally: escape the `.` so that sed doesn't treat
+# them as wildcards (`2.0.0` would otherwise also match e.g. `2.010`)
+PREVIOUS_VERSION_RE=$(printf '%s' "$PREVIOUS_VERSION" | sed -e 's/\./\\./g')
 
-${FD} wasmer.iss --exec sed -i '{}' -e "s/AppVersion=$PREVIOUS_VERSION/AppVersion=$NEXT_VERSION/"
+# Only tracked files are considered (so `target/` is never walked) and only the
+# files that contain the previous version are rewritten, the others are left untouched.
+# Both the crates and the installer are updated in a single pass.
+git ls-files -z -- ':(glob)**/Cargo.toml' ':(glob)**/wasmer.iss' \
+    | xargs -0 grep -lZF -e "version = \"$PREVIOUS_VERSION\"" -e "AppVersion=$PREVIOUS_VERSION" \
+    | xargs -0r sed -i \
+        -e "s/version = \"$PREVIOUS_VERSION_RE\"/version = \"$NEXT_VERSION\"/" \
+        -e "s/AppVersion=$PREVIOUS_VERSION_RE/AppVersion=$NEXT_VERSION/"
+echo "manually check changes to Cargo.toml"
 echo "manually check changes to wasmer.iss"
 
 # Order to upload packages in